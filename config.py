@@ -1,12 +1,63 @@
 import os
+from typing import Any, Dict, Optional, Tuple
 
 from dotenv import load_dotenv
 
 
+# Settings read on hot paths, snapshotted once by load_env()
+_CFG: Dict[str, Any] = {}
+
+
+def _coerce_api_key(val: Optional[str]) -> Optional[str]:
+	if not val:
+		return None
+	return val.strip().strip("\"'")
+
+
+def _parse_int(val: Optional[str], default: int) -> int:
+	try:
+		return max(1, int(val)) if val else default
+	except ValueError:
+		return default
+
+
 def load_env() -> None:
 	"""Load environment variables from .env."""
 	load_dotenv()
+	keys = (_coerce_api_key(k) for k in os.getenv("GEMINI_API_KEYS", "").split(","))
+	_CFG["api_keys"] = tuple(k for k in keys if k)
+	_CFG["rpm"] = _parse_int(os.getenv("GEMINI_RPM"), 15)
+	_CFG["tpm"] = _parse_int(os.getenv("GEMINI_TPM"), 250_000)
+	_CFG["max_concurrency"] = _parse_int(os.getenv("GEMINI_MAX_CONCURRENCY"), 5)
+	_CFG["cache_path"] = os.getenv("GEMINI_CACHE_PATH") or os.path.expanduser("~/.autofill_cache")
+	_CFG["webhook_url"] = os.getenv("DISCORD_WEBHOOK_URL", "").strip()
+
+
+def _get(name: str) -> Any:
+	if not _CFG:
+		load_env()
+	return _CFG[name]
 
 
 def get_webhook_url() -> str:
-	return os.getenv("DISCORD_WEBHOOK_URL", "").strip()
\ No newline at end of file
+	return _get("webhook_url")
+
+
+def get_api_keys() -> Tuple[str, ...]:
+	return _get("api_keys")
+
+
+def get_gemini_rpm() -> int:
+	return _get("rpm")
+
+
+def get_gemini_tpm() -> int:
+	return _get("tpm")
+
+
+def get_gemini_max_concurrency() -> int:
+	return _get("max_concurrency")
+
+
+def get_cache_path() -> str:
+	return _get("cache_path")
\ No newline at end of file
@@ -0,0 +1,46 @@
+import threading
+
+
+class Concurrency:
+	"""AIMD limit on in-flight Gemini requests.
+
+	The limit grows by `alpha` after each call that finishes within
+	`target_latency`, and is multiplied by `beta` after a 429/5xx.
+	"""
+
+	def __init__(
+		self,
+		c_max: int,
+		c_min: int = 1,
+		alpha: float = 0.5,
+		beta: float = 0.5,
+		target_latency: float = 5.0,
+		c_start: int = 1,
+	) -> None:
+		self.c_min = c_min
+		self.c_max = max(c_min, c_max)
+		self.alpha = alpha
+		self.beta = beta
+		self.target_latency = target_latency
+		self.c = float(min(self.c_max, max(c_min, c_start)))
+		self._in_flight = 0
+		self._cond = threading.Condition()
+
+	def acquire(self) -> None:
+		with self._cond:
+			while self._in_flight >= int(self.c):
+				self._cond.wait()
+			self._in_flight += 1
+
+	def release(self) -> None:
+		with self._cond:
+			self._in_flight -= 1
+			self._cond.notify_all()
+
+	def observe(self, latency: float, error: bool) -> None:
+		with self._cond:
+			if error:
+				self.c = max(float(self.c_min), self.c * self.beta)
+			elif latency <= self.target_latency:
+				self.c = min(float(self.c_max), self.c + self.alpha)
+			self._cond.notify_all()
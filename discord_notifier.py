@@ -1,6 +1,17 @@
-from typing import List, Optional
+import queue
+import threading
+import time
+from typing import List, Optional, Tuple
 
 import requests
+from requests.adapters import HTTPAdapter
+
+
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16))
+_Q: "queue.Queue[Tuple[str, dict]]" = queue.Queue(maxsize=64)
+_worker: Optional[threading.Thread] = None
+_worker_lock = threading.Lock()
 
 
 def _truncate(text: str, limit: int) -> str:
@@ -9,6 +20,50 @@ def _truncate(text: str, limit: int) -> str:
 	return text[: limit - 3] + "..."
 
 
+def _retry_after(resp: requests.Response) -> float:
+	try:
+		return float(resp.headers.get("Retry-After", "1"))
+	except ValueError:
+		return 1.0
+
+
+def _post(webhook_url: str, payload: dict) -> None:
+	for _ in range(3):
+		try:
+			resp = _SESSION.post(webhook_url, json=payload, timeout=10)
+		except Exception as e:
+			print(f"Discord webhook error: {e}")
+			return
+		if resp.status_code != 429:
+			return
+		time.sleep(_retry_after(resp))
+	print("Discord webhook still rate limited; dropping message.")
+
+
+def _drain() -> None:
+	while True:
+		webhook_url, payload = _Q.get()
+		try:
+			_post(webhook_url, payload)
+		finally:
+			_Q.task_done()
+
+
+def _ensure_worker() -> None:
+	global _worker
+	with _worker_lock:
+		if _worker is None or not _worker.is_alive():
+			_worker = threading.Thread(target=_drain, name="discord-notifier", daemon=True)
+			_worker.start()
+
+
+def flush_discord(timeout: float = 10.0) -> None:
+	"""Give queued webhook posts up to `timeout` seconds to go out."""
+	deadline = time.monotonic() + timeout
+	while _Q.unfinished_tasks and time.monotonic() < deadline:
+		time.sleep(0.1)
+
+
 def send_discord_batch(
 	webhook_url: str,
 	page_num: int,
@@ -42,7 +97,9 @@ def send_discord_batch(
 		]
 	}
 
+	# Posted from a background thread so the page loop never waits on Discord
+	_ensure_worker()
 	try:
-		requests.post(webhook_url, json=payload, timeout=10)
-	except Exception as e:
-		print(f"Discord webhook error: {e}")
\ No newline at end of file
+		_Q.put_nowait((webhook_url, payload))
+	except queue.Full:
+		print("Discord queue full; dropping batch results.")
\ No newline at end of file
@@ -1,97 +1,419 @@
+import atexit
+import hashlib
 import json
-import os
+import queue
+import random
 import re
-from typing import List, Optional
+import shelve
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, MutableMapping, Optional, Tuple
 
 from google import genai
+from google.genai import errors, types
 
+try:
+	import orjson
+	_json_loads = orjson.loads
+except ImportError:  # optional; stdlib json is fine, just slower
+	_json_loads = json.loads
+
+from config import get_api_keys, get_cache_path, get_gemini_max_concurrency, get_gemini_rpm, get_gemini_tpm
+from controller import Concurrency
+from key_pool import KeyPool
 from models import MCQ
 
 
-current_api_key_idx = 0
+MAX_QUOTA_RETRIES = 6
+MAX_SERVER_RETRIES = 3
+MODEL_COOLDOWN = 60.0
+_key_pool: Optional[KeyPool] = None
+_controller: Optional[Concurrency] = None
+_CLIENTS: Dict[str, genai.Client] = {}
+_model_health: Dict[str, float] = {}  # model -> time.monotonic() of its last failure
+_answer_cache: Optional[MutableMapping[str, int]] = None
+_cache_lock = threading.Lock()
+_init_lock = threading.Lock()  # chunk threads share the lazily built singletons below
+_RETRY_DELAY_RE = re.compile(r"retry_?delay\D*?(\d+(?:\.\d+)?)", re.IGNORECASE)
+_ANSWER_PAIR_RE = re.compile(r'"q"\s*:\s*(\d+)\s*,\s*"answer"\s*:\s*(\d+)')
+_BAD_KEY_RE = re.compile(r"API_KEY_(?:INVALID|EXPIRED)|API key (?:not valid|expired)", re.IGNORECASE)
+# Only pairs whose number is closed off, so a streamed "answer":1 can't be the start of 12
+_CLOSED_PAIR_RE = re.compile(_ANSWER_PAIR_RE.pattern + r"(?=\s*[,}])")
+
+# Identical for every request, so it goes in the system instruction rather than each prompt
+_SYSTEM_INSTRUCTION = (
+	"You are answering multiple-choice questions. "
+	"Return ONLY valid JSON in this exact format: "
+	"{\"answers\":[{\"q\":1,\"answer\":<number>},...]}\n"
+	"Rules:\n"
+	"- answer must be the option number (1-based)\n"
+	"- include every question exactly once\n"
+	"- no extra keys, no markdown, no commentary"
+)
+_GENERATE_CONFIG = types.GenerateContentConfig(
+	system_instruction=_SYSTEM_INSTRUCTION,
+	response_mime_type="application/json",
+)
+
+
+def _get_client(api_key: str) -> genai.Client:
+	client = _CLIENTS.get(api_key)
+	if client is None:
+		with _init_lock:
+			client = _CLIENTS.get(api_key)
+			if client is None:
+				client = _CLIENTS[api_key] = genai.Client(api_key=api_key)
+	return client
+
+
+def _get_key_pool(keys: Tuple[str, ...]) -> KeyPool:
+	global _key_pool
+	with _init_lock:
+		if _key_pool is None:
+			_key_pool = KeyPool(keys, rpm=get_gemini_rpm(), tpm=get_gemini_tpm())
+		return _key_pool
+
+
+def _get_controller(key_count: int) -> Concurrency:
+	global _controller
+	with _init_lock:
+		if _controller is None:
+			cap = get_gemini_max_concurrency()
+			_controller = Concurrency(c_max=min(key_count * 2, cap), c_start=min(key_count, cap))
+		return _controller
+
+
+def _is_quota_error(err: Exception) -> bool:
+	if isinstance(err, errors.APIError) and err.code == 429:
+		return True
+	return "RESOURCE_EXHAUSTED" in str(err) or "429" in str(err)
+
+
+def _is_key_error(err: Exception) -> bool:
+	"""Errors that mean the key itself is unusable (unauthenticated, invalid or expired); another key may still work."""
+	if not isinstance(err, errors.ClientError):
+		return False
+	return err.code == 401 or bool(_BAD_KEY_RE.search(str(err)))
+
+
+def _is_model_error(err: Exception) -> bool:
+	"""Errors that belong to the model (overloaded, down, not found or not allowed for this key)."""
+	if isinstance(err, errors.ServerError):
+		return True
+	if not isinstance(err, errors.APIError) or _is_key_error(err):
+		return False
+	return err.code in (403, 404) or err.status in ("PERMISSION_DENIED", "NOT_FOUND")
+
+
+def _is_fatal_error(err: Exception) -> bool:
+	"""Request errors that no other key or model will fix."""
+	if not isinstance(err, errors.ClientError) or err.code == 429 or _is_key_error(err):
+		return False
+	return err.status in ("INVALID_ARGUMENT", "FAILED_PRECONDITION")
+
+
+def _parse_retry_delay(err: Exception) -> Optional[float]:
+	"""Extract Gemini's RetryInfo delay (seconds) from a quota error, if present."""
+	if isinstance(err, errors.APIError) and isinstance(err.details, dict):
+		payload = err.details.get("error", err.details)
+		details = payload.get("details") if isinstance(payload, dict) else None
+		for detail in details or []:
+			if isinstance(detail, dict) and detail.get("retryDelay"):
+				try:
+					return float(str(detail["retryDelay"]).rstrip("s"))
+				except ValueError:
+					break
+	match = _RETRY_DELAY_RE.search(str(err))
+	if match:
+		return float(match.group(1))
+	return None
+
+
+def _jittered_backoff(attempt: int, cap: float = 32.0) -> float:
+	"""Exponential delay (2s, 4s, 8s...) capped at `cap`, plus up to 20% random jitter."""
+	base = min(cap, 2 ** attempt)
+	return base + random.uniform(0, 0.2 * base)
+
+
+def _backoff_delay(err: Exception, attempt: int) -> float:
+	"""Seconds to wait after a quota error; never shorter than the delay Gemini asks for."""
+	return max(_parse_retry_delay(err) or 0.0, _jittered_backoff(attempt))
+
+
+def _healthy_models(models: List[str]) -> List[str]:
+	"""Models that haven't failed within MODEL_COOLDOWN; all of them if every one has."""
+	now = time.monotonic()
+	healthy = [m for m in models if now - _model_health.get(m, float("-inf")) >= MODEL_COOLDOWN]
+	return healthy or models
+
+
+def _response_text(response) -> str:
+	if not response.candidates or not response.candidates[0].content or not response.candidates[0].content.parts:
+		return ""
+	return "".join(part.text for part in response.candidates[0].content.parts if getattr(part, "text", None))
+
+
+def _generate(
+	client: genai.Client,
+	model: str,
+	prompt: str,
+	controller: Concurrency,
+	on_text: Optional[Callable[[str], None]] = None,
+) -> str:
+	"""Stream one generate_content call and return its text.
 
+	on_text is called with the text received so far after every streamed chunk.
+	"""
+	controller.acquire()
+	started = time.monotonic()
+	overloaded = False
+	try:
+		text = ""
+		for chunk in client.models.generate_content_stream(model=model, contents=prompt, config=_GENERATE_CONFIG):
+			piece = _response_text(chunk)
+			if piece:
+				text += piece
+				if on_text:
+					on_text(text)
+		return text
+	except Exception as e:
+		overloaded = isinstance(e, errors.ServerError) or _is_quota_error(e)
+		raise
+	finally:
+		controller.release()
+		controller.observe(time.monotonic() - started, overloaded)
 
-def _coerce_api_key(val: Optional[str]) -> Optional[str]:
-	if not val:
-		return None
-	return val.strip().strip('"').strip("'")
 
+def _parse_answers(text: str, questions: List[MCQ]) -> List[Optional[int]]:
+	"""Read {"answers":[{"q":..,"answer":..}]}, scanning for q/answer pairs if the JSON is fenced or cut off."""
+	try:
+		pairs = [(item.get("q"), item.get("answer")) for item in _json_loads(text).get("answers", [])]
+	except (ValueError, AttributeError, TypeError):
+		pairs = _ANSWER_PAIR_RE.findall(text)
+	return _answers_from_pairs(pairs, questions)
 
-def _get_api_keys() -> List[str]:
-	raw_keys = os.getenv("GEMINI_API_KEYS", "").split(",")
-	keys = [_coerce_api_key(k) for k in raw_keys]
-	keys = [k for k in keys if k]
-	return keys
+
+def _answers_from_pairs(pairs, questions: List[MCQ]) -> List[Optional[int]]:
+	answers: List[Optional[int]] = [None for _ in questions]
+	for q, ans in pairs:
+		try:
+			q_idx = int(q) - 1
+			ans = int(ans)
+		except (TypeError, ValueError):
+			continue
+		if 0 <= q_idx < len(questions) and 1 <= ans <= len(questions[q_idx].options):
+			answers[q_idx] = ans
+	return answers
+
+
+def _get_answer_cache() -> MutableMapping[str, int]:
+	"""Disk-backed answers from earlier runs; falls back to memory if the file can't be opened."""
+	global _answer_cache
+	if _answer_cache is None:
+		path = get_cache_path()
+		try:
+			shelf = shelve.open(path)
+			atexit.register(shelf.close)
+			_answer_cache = shelf
+		except Exception as e:
+			print(f"Answer cache unavailable ({e}); using memory only.")
+			_answer_cache = {}
+	return _answer_cache
+
+
+def _normalize(text: str) -> str:
+	return " ".join(text.split()).lower()
+
+
+def _cache_key(q: MCQ) -> str:
+	"""Same key for questions that differ only in case or whitespace."""
+	raw = _normalize(q.question_text) + "|" + "|".join(_normalize(o) for o in q.options)
+	return hashlib.sha1(raw.encode("utf-8")).hexdigest()
 
 
 def ask_gemini_batch(questions: List[MCQ]) -> List[Optional[int]]:
 	"""Ask Gemini for a batch of questions. Returns 1-based indices or None when unresolved."""
-	global current_api_key_idx
-	keys = _get_api_keys()
+	answers: List[Optional[int]] = [None for _ in questions]
+	for idxs, part in iter_gemini_batch(questions):
+		for i, ans in zip(idxs, part):
+			answers[i] = ans
+	return answers
+
+
+def iter_gemini_batch(questions: List[MCQ]) -> Iterator[Tuple[List[int], List[Optional[int]]]]:
+	"""Like ask_gemini_batch, but yields (question indices, answers) as answers stream in."""
+	cache_keys = [_cache_key(q) for q in questions]
+	with _cache_lock:
+		cache = _get_answer_cache()
+		cached: List[Optional[int]] = [cache.get(k) for k in cache_keys]
+	hits = [i for i, a in enumerate(cached) if a is not None]
+	if hits:
+		print(f"Reusing {len(hits)} cached answer(s).")
+		yield hits, [cached[i] for i in hits]
+
+	# Ask once per distinct question; repeats on the page share the answer
+	misses: Dict[str, List[int]] = {}
+	for i, a in enumerate(cached):
+		if a is None:
+			misses.setdefault(cache_keys[i], []).append(i)
+	if not misses:
+		return
+	unique = [idxs[0] for idxs in misses.values()]
+	if len(unique) < sum(len(idxs) for idxs in misses.values()):
+		print(f"Asking once for {len(unique)} distinct question(s).")
+
+	for positions, fetched in _fetch_answers([questions[i] for i in unique]):
+		idxs: List[int] = []
+		answers: List[Optional[int]] = []
+		with _cache_lock:
+			for p, ans in zip(positions, fetched):
+				key = cache_keys[unique[p]]
+				if ans is not None:
+					cache[key] = ans
+				idxs.extend(misses[key])
+				answers.extend(ans for _ in misses[key])
+			if isinstance(cache, shelve.Shelf):
+				cache.sync()
+		yield idxs, answers
+
+
+def _fetch_answers(questions: List[MCQ]) -> Iterator[Tuple[List[int], List[Optional[int]]]]:
+	"""Yield (positions, answers) as they stream in; every position is yielded exactly once."""
+	keys = get_api_keys()
 	if not keys:
 		print("No API keys set. Skipping batch.")
-		return [None for _ in questions]
+		yield list(range(len(questions))), [None for _ in questions]
+		return
+	pool = _get_key_pool(keys)
+
+	# Quotas are per key, so split the batch and let every key answer a share at once
+	size = -(-len(questions) // len(keys))
+	starts = range(0, len(questions), size)
+	updates: "queue.Queue[Tuple[List[int], List[Optional[int]], bool]]" = queue.Queue()
 
+	def run_chunk(start: int) -> None:
+		chunk = questions[start:start + size]
+		sent = set()
+
+		def emit(positions: List[int], answers: List[Optional[int]]) -> None:
+			sent.update(positions)
+			updates.put(([start + p for p in positions], answers, False))
+
+		answers: List[Optional[int]] = [None for _ in chunk]
+		try:
+			answers = _ask_gemini_chunk(chunk, pool, emit)
+		finally:
+			rest = [p for p in range(len(chunk)) if p not in sent]
+			updates.put(([start + p for p in rest], [answers[p] for p in rest], True))
+
+	with ThreadPoolExecutor(max_workers=len(starts)) as executor:
+		futures = [executor.submit(run_chunk, i) for i in starts]
+		pending = len(futures)
+		while pending:
+			positions, answers, done = updates.get()
+			pending -= done
+			# Merge whatever else arrived meanwhile so the caller clicks it in one go
+			while pending:
+				try:
+					more_positions, more_answers, more_done = updates.get_nowait()
+				except queue.Empty:
+					break
+				positions, answers = positions + more_positions, answers + more_answers
+				pending -= more_done
+			if positions:
+				yield positions, answers
+		for future in futures:
+			future.result()
+
+
+def _ask_gemini_chunk(
+	questions: List[MCQ],
+	pool: KeyPool,
+	emit: Optional[Callable[[List[int], List[Optional[int]]], None]] = None,
+) -> List[Optional[int]]:
+	"""Answer questions in one prompt, drawing keys from the pool and parking them on quota errors.
+
+	emit, if given, receives (positions, answers) for answers completed mid-stream; those are final.
+	"""
 	models = ["gemini-2.5-flash", "gemini-2.5-flash-lite", "gemini-3-flash-preview"]  # Priority order
 
-	items = []
-	for i, q in enumerate(questions, start=1):
-		opts = "\n".join([f"{j+1}. {opt}" for j, opt in enumerate(q.options)])
-		items.append(f"Q{i}: {q.question_text}\nOptions:\n{opts}")
-
-	prompt = (
-		"You are answering multiple-choice questions. "
-		"Return ONLY valid JSON in this exact format: "
-		"{\"answers\":[{\"q\":1,\"answer\":<number>},...]}\n"
-		"Rules:\n"
-		"- answer must be the option number (1-based)\n"
-		"- include every question exactly once\n"
-		"- no extra keys, no markdown, no commentary\n\n"
-		+ "\n\n".join(items)
+	items = (
+		f"Q{i}: {q.question_text}\nOptions:\n" + "\n".join(f"{j+1}. {opt}" for j, opt in enumerate(q.options))
+		for i, q in enumerate(questions, start=1)
 	)
 
-	current_idx = current_api_key_idx
-	for _ in range(20):
-		api_key = keys[current_idx]
-		client = genai.Client(api_key=api_key)
-		switch_key = False
+	prompt = "\n\n".join(items)
+
+	est_tokens = (len(_SYSTEM_INSTRUCTION) + len(prompt)) // 4
+	controller = _get_controller(len(pool.keys))
+	key_attempts: Dict[str, int] = {}
+	quota_retries = 0
+	server_retries = 0
+	# Quota errors have their own budget; anything else gets one pass over the models per key
+	failures = 0
+	max_failures = len(models) * len(pool.keys)
+	emitted: Dict[int, int] = {}
 
-		for model in models:
+	def on_text(text: str) -> None:
+		fresh = [
+			(i, a) for i, a in enumerate(_answers_from_pairs(_CLOSED_PAIR_RE.findall(text), questions))
+			if a is not None and i not in emitted
+		]
+		if fresh:
+			emitted.update(fresh)
+			emit([i for i, _ in fresh], [a for _, a in fresh])
+
+	for _ in range(20):
+		for model in _healthy_models(models):
+			overloaded = False
+			api_key = pool.acquire(est_tokens)
+			if api_key is None:
+				print("Every Gemini key was rejected. Skipping batch.")
+				return [None for _ in questions]
 			try:
-				response = client.models.generate_content(model=model, contents=prompt)
-				if not response.candidates or not response.candidates[0].content or not response.candidates[0].content.parts:
+				text = _generate(_get_client(api_key), model, prompt, controller, on_text if emit else None)
+				if not text:
 					print(f"No valid response from {model}. Trying next model...")
-					continue
-				text = "".join([part.text for part in response.candidates[0].content.parts if hasattr(part, 'text')])
-
-				try:
-					data = json.loads(text.strip())
-				except json.JSONDecodeError:
-					continue
-
-				answers = [None for _ in questions]
-				for item in data.get("answers", []):
-					try:
-						q_idx = int(item.get("q")) - 1
-						ans = int(item.get("answer"))
-						if 0 <= q_idx < len(questions) and 1 <= ans <= len(questions[q_idx].options):
-							answers[q_idx] = ans
-					except Exception:
-						continue
-
-				if any(a is not None for a in answers):
-					return answers
+					_model_health[model] = time.monotonic()
+				else:
+					answers = _parse_answers(text, questions)
+					answers = [emitted.get(i, a) for i, a in enumerate(answers)]  # keep what was already clicked
+					if any(a is not None for a in answers):
+						_model_health.pop(model, None)
+						return answers
 			except Exception as e:
-				if "RESOURCE_EXHAUSTED" in str(e) or "429" in str(e):
-					print(f"Quota exceeded on {model} with key {current_idx + 1}. Switching to next key...")
-					switch_key = True
+				if _is_quota_error(e):
+					quota_retries += 1
+					if quota_retries > MAX_QUOTA_RETRIES:
+						print("Quota retries exhausted. Skipping batch.")
+						return [None for _ in questions]
+					key_attempts[api_key] = key_attempts.get(api_key, 0) + 1
+					delay = _backoff_delay(e, key_attempts[api_key])
+					print(f"Quota exceeded on {model} with key {pool.keys.index(api_key) + 1}. Parking it for {delay:.1f}s...")
+					pool.penalize(api_key, delay)
 					break
+				if _is_key_error(e):
+					print(f"Gemini rejected key {pool.keys.index(api_key) + 1}: {e}. Dropping it from rotation.")
+					pool.disable(api_key)
+					break  # start over from the preferred model on another key
+				if _is_fatal_error(e):
+					print(f"Gemini rejected the request: {e}. Skipping batch.")
+					return [None for _ in questions]
 				print(f"Error with {model}: {e}. Trying next model...")
-				continue
+				if _is_model_error(e):
+					_model_health[model] = time.monotonic()
+				overloaded = isinstance(e, errors.ServerError)
 
-		current_api_key_idx = (current_idx + 1) % len(keys)
-		current_idx = current_api_key_idx
-		if switch_key:
-			continue
+			failures += 1
+			if failures >= max_failures:
+				print("Every model failed. Skipping batch.")
+				return [None for _ in questions]
+			# 5xx backoffs are budgeted per batch, not per call
+			if overloaded and server_retries < MAX_SERVER_RETRIES:
+				server_retries += 1
+				delay = _jittered_backoff(server_retries - 1, cap=4.0)
+				print(f"Backing off {delay:.1f}s ({server_retries}/{MAX_SERVER_RETRIES})...")
+				time.sleep(delay)
 
 	return [None for _ in questions]
\ No newline at end of file
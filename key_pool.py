@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, Iterable, Optional, Set, Tuple
+
+
+class KeyPool:
+	"""Hands out the API key with the most rate-limit headroom.
+
+	Each key keeps a rolling window of (timestamp, estimated tokens) and is only
+	used up to `safety` of its RPM and TPM. Keys that hit a 429 are parked until
+	their cooldown ends, and keys the API rejects are dropped for good; callers
+	only sleep when every remaining key is saturated or parked.
+	"""
+
+	def __init__(
+		self,
+		keys: Iterable[str],
+		rpm: int,
+		tpm: int = 250_000,
+		window: float = 60.0,
+		safety: float = 0.8,
+	) -> None:
+		self.keys: Tuple[str, ...] = tuple(keys)
+		self.limit = max(1, int(rpm * safety))
+		self.token_limit = max(1, int(tpm * safety))
+		self.window = window
+		self._calls: Dict[str, Deque[Tuple[float, int]]] = {k: deque() for k in self.keys}
+		self._tokens: Dict[str, int] = {k: 0 for k in self.keys}
+		self._cooldown_until: Dict[str, float] = {k: 0.0 for k in self.keys}
+		self._disabled: Set[str] = set()
+		self._lock = threading.Lock()
+
+	def acquire(self, est_tokens: int = 0) -> Optional[str]:
+		"""Reserve a request slot on the least-loaded key, waiting if none is free. None once every key is disabled."""
+		while True:
+			with self._lock:
+				usable = [k for k in self.keys if k not in self._disabled]
+				if not usable:
+					return None
+				now = time.monotonic()
+				for k in usable:
+					self._prune(k, now)
+				key = min(usable, key=lambda k: (self._wait_time(k, now, est_tokens), len(self._calls[k])))
+				delay = self._wait_time(key, now, est_tokens)
+				if delay <= 0:
+					self._calls[key].append((now, est_tokens))
+					self._tokens[key] += est_tokens
+					return key
+			print(f"All Gemini keys are rate limited. Waiting {delay:.1f}s...")
+			time.sleep(delay)
+
+	def penalize(self, key: str, seconds: float) -> None:
+		"""Keep key out of rotation for the next `seconds`."""
+		with self._lock:
+			self._cooldown_until[key] = max(self._cooldown_until[key], time.monotonic() + seconds)
+
+	def disable(self, key: str) -> None:
+		"""Take a key the API rejected out of rotation for the rest of the run."""
+		with self._lock:
+			self._disabled.add(key)
+
+	def _prune(self, key: str, now: float) -> None:
+		calls = self._calls[key]
+		while calls and calls[0][0] <= now - self.window:
+			self._tokens[key] -= calls.popleft()[1]
+
+	def _wait_time(self, key: str, now: float, est_tokens: int = 0) -> float:
+		wait = self._cooldown_until[key] - now
+		calls = self._calls[key]
+		if len(calls) >= self.limit:
+			wait = max(wait, calls[0][0] + self.window - now)
+		# Wait for enough old calls to age out that this one fits under the token budget
+		excess = self._tokens[key] + est_tokens - self.token_limit
+		for ts, tokens in calls:
+			if excess <= 0:
+				break
+			excess -= tokens
+			wait = max(wait, ts + self.window - now)
+		return max(0.0, wait)
@@ -1,22 +1,27 @@
+import functools
 import os
 import re
 import sys
 import time
-from typing import List
+from typing import List, NamedTuple, Tuple
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.edge.options import Options as EdgeOptions
 from selenium.webdriver.chrome.options import Options as ChromeOptions
-from selenium.webdriver.common.action_chains import ActionChains
+from selenium.common.exceptions import TimeoutException, WebDriverException
 
 from config import get_webhook_url, load_env
-from discord_notifier import send_discord_batch
-from gemini_client import ask_gemini_batch
+from discord_notifier import flush_discord, send_discord_batch
+from gemini_client import iter_gemini_batch
 from models import MCQ
 
 
+_BRACKET_RE = re.compile(r'\[.*?\]')
+
+
+@functools.lru_cache(maxsize=1)
 def _get_chrome_user_data_dir() -> str:
 	"""Resolve Chrome profile directory on Windows."""
 	override = os.getenv("CHROME_USER_DATA_DIR")
@@ -28,6 +33,7 @@ def _get_chrome_user_data_dir() -> str:
 	return r"C:\Users\%USERNAME%\AppData\Local\Google\Chrome\User Data"
 
 
+@functools.lru_cache(maxsize=1)
 def _get_edge_user_data_dir() -> str:
 	"""Resolve Edge profile directory on Windows."""
 	override = os.getenv("EDGE_USER_DATA_DIR")
@@ -39,14 +45,39 @@ def _get_edge_user_data_dir() -> str:
 	return r"C:\Users\%USERNAME%\AppData\Local\Microsoft\Edge\User Data"
 
 
+@functools.lru_cache(maxsize=1)
 def _get_profile_name() -> str:
 	return os.getenv("BROWSER_PROFILE_NAME", "Default")
 
 
+@functools.lru_cache(maxsize=1)
 def _get_browser_choice() -> str:
 	return os.getenv("BROWSER", "edge").lower()
 
 
+@functools.lru_cache(maxsize=1)
+def _is_headless() -> bool:
+	return os.getenv("HEADLESS", "0") == "1"
+
+
+@functools.lru_cache(maxsize=1)
+def _blocks_images() -> bool:
+	return os.getenv("BLOCK_IMAGES", "0") == "1"
+
+
+# Pictures and web fonts only; Forms' scripts and styles also come from gstatic, so that host stays open.
+# Question, header and avatar images are extensionless lh*.googleusercontent.com URLs.
+_BLOCKED_URLS = ["*googleusercontent.com/*", "*.png", "*.jpg", "*.jpeg", "*.gif", "*.webp", "*.woff", "*.woff2"]
+
+
+def _apply_speed_options(opts) -> None:
+	"""Return from driver.get() at DOMContentLoaded; optionally skip rendering a window."""
+	opts.page_load_strategy = "eager"
+	if _is_headless():
+		opts.add_argument("--headless=new")
+		opts.add_argument("--disable-gpu")
+
+
 # ----------------------------
 # Browser (Selenium)
 # ----------------------------
@@ -65,6 +96,7 @@ def launch_browser(url: str):
 		opts.add_argument("--log-level=3")
 		opts.add_experimental_option("excludeSwitches", ["enable-logging", "enable-automation"])
 		opts.add_experimental_option("useAutomationExtension", False)
+		_apply_speed_options(opts)
 		driver = webdriver.Chrome(options=opts)
 	else:
 		user_data_dir = _get_edge_user_data_dir()
@@ -79,8 +111,16 @@ def launch_browser(url: str):
 			opts.add_experimental_option("useAutomationExtension", False)
 		except Exception:
 			pass
+		_apply_speed_options(opts)
 		driver = webdriver.Edge(options=opts)
 
+	if _blocks_images():
+		try:
+			driver.execute_cdp_cmd("Network.enable", {})
+			driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": _BLOCKED_URLS})
+		except Exception as e:
+			print(f"Could not block images: {e}")
+
 	driver.get(url)
 	WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
 	return driver
@@ -91,98 +131,210 @@ def launch_browser(url: str):
 # ----------------------------
 def extract_mcqs(driver) -> List[MCQ]:
 	"""Extract MCQ questions (radio or checkboxes) from the current Google Form page."""
+	js = """
+	function collect(els) {
+		var labels = [], nodes = [];
+		Array.from(els).forEach(function(o){
+			var t = (o.getAttribute('aria-label') || o.innerText || '').trim();
+			if (t) { labels.push(t); nodes.push(o); }
+		});
+		return {options: labels, option_elements: nodes};
+	}
+	function row(kind, qt, opts) {
+		return {kind: kind, question_text: qt, options: opts.options, option_elements: opts.option_elements};
+	}
+	// Checkbox rows are listitems themselves, so only top-level listitems are question cards
+	function outerCard(el) {
+		var card = null, c = el.closest("div[role='listitem']");
+		while (c) {
+			card = c;
+			c = c.parentElement && c.parentElement.closest("div[role='listitem']");
+		}
+		return card;
+	}
+	var cards = Array.from(document.querySelectorAll("div[role='listitem']")).filter(function(c){
+		return !(c.parentElement && c.parentElement.closest("div[role='listitem']"));
+	});
+	// One sweep over every heading/option on the page, grouped by owning card
+	var groups = new Map(cards.map(function(c){ return [c, {heading: null, rg: null, radios: [], checks: []}]; }));
+	document.querySelectorAll("[role='heading'],[role='radio'],[role='checkbox']").forEach(function(el){
+		var g = groups.get(outerCard(el));
+		if (!g) return;
+		var role = el.getAttribute('role');
+		if (role === 'heading') {
+			if (!g.heading) g.heading = el;
+		} else if (role === 'radio') {
+			var rg = el.closest("[role='radiogroup']");
+			if (rg && !g.rg) g.rg = rg;
+			if (rg && rg === g.rg) g.radios.push(el);
+		} else {
+			g.checks.push(el);
+		}
+	});
+	return cards.map(function(c){
+		var g = groups.get(c);
+		var qt = (g.heading ? g.heading.innerText : (c.innerText || '').split('\\n')[0]).trim();
+		qt = qt.replace(/\\[.*?\\]/g, '').trim();
+		if (!qt) return null;
+		var radios = collect(g.radios);
+		if (radios.options.length) return row('radio', qt, radios);
+		var checks = collect(g.checks);
+		if (checks.options.length) return row('checkbox', qt, checks);
+		return null;
+	}).filter(function(r){ return r; });
+	"""
+	try:
+		rows = driver.execute_script(js)
+	except Exception as e:
+		print(f"Fast extraction failed ({e}); scanning elements one by one.")
+		rows = None
+
+	mcqs = _extract_mcqs_slow(driver) if rows is None else [MCQ(**row) for row in rows]
+
+	print(f"Detected {len(mcqs)} MCQ question(s) on this page.")
+	return mcqs
+
+
+def _collect_options(driver, opts) -> Tuple[List[str], list]:
+	"""Labels for option elements, read in one script instead of two commands per option."""
+	if not opts:
+		return [], []
+	labels = driver.execute_script(
+		"return arguments[0].map(function(o){ return (o.getAttribute('aria-label') || o.innerText || '').trim(); });",
+		opts,
+	)
+	pairs = [(label, opt) for label, opt in zip(labels, opts) if label]
+	return [label for label, _ in pairs], [opt for _, opt in pairs]
+
+
+def _extract_mcqs_slow(driver) -> List[MCQ]:
+	"""Element-by-element fallback for extract_mcqs."""
 	mcqs: List[MCQ] = []
-	question_cards = driver.find_elements(By.CSS_SELECTOR, "div[role='listitem']")
+	# Checkbox rows are nested listitems; only top-level ones are question cards
+	question_cards = driver.find_elements(By.XPATH, "//div[@role='listitem'][not(ancestor::div[@role='listitem'])]")
 	
 	for card in question_cards:
 		# Get question text
 		q_headings = card.find_elements(By.CSS_SELECTOR, "[role='heading']")
 		question_text = q_headings[0].text.strip() if q_headings else card.text.split("\n")[0].strip()
-		question_text = re.sub(r'\[.*?\]', '', question_text).strip()
+		question_text = _BRACKET_RE.sub('', question_text).strip()
 		if not question_text:
 			continue
 
 		# Check for radio buttons
 		radio_groups = card.find_elements(By.CSS_SELECTOR, "[role='radiogroup']")
 		if radio_groups:
-			options = []
-			for opt in radio_groups[0].find_elements(By.CSS_SELECTOR, "[role='radio']"):
-				label = opt.get_attribute("aria-label") or opt.text or ""
-				if label.strip():
-					options.append(label.strip())
+			options, elements = _collect_options(driver, radio_groups[0].find_elements(By.CSS_SELECTOR, "[role='radio']"))
 			if options:
-				mcqs.append(MCQ(kind="radio", question_text=question_text, options=options))
+				mcqs.append(MCQ(
+					kind="radio",
+					question_text=question_text,
+					options=options,
+					option_elements=elements,
+				))
 				continue
 
 		# Check for checkboxes
 		checkboxes = card.find_elements(By.CSS_SELECTOR, "[role='checkbox']")
 		if checkboxes:
-			options = []
-			for opt in checkboxes:
-				label = opt.get_attribute("aria-label") or opt.text or ""
-				if label.strip():
-					options.append(label.strip())
+			options, elements = _collect_options(driver, checkboxes)
 			if options:
-				mcqs.append(MCQ(kind="checkbox", question_text=question_text, options=options))
+				mcqs.append(MCQ(
+					kind="checkbox",
+					question_text=question_text,
+					options=options,
+					option_elements=elements,
+				))
 
-	print(f"Detected {len(mcqs)} MCQ question(s) on this page.")
 	return mcqs
 
 
 # ----------------------------
 # Selection
 # ----------------------------
-def select_answer(driver, question_idx: int, answer_idx: int) -> None:
-	"""Click the chosen answer on the page."""
-	cards = driver.find_elements(By.CSS_SELECTOR, "div[role='listitem']")
-	mcq_cards = [i for i, card in enumerate(cards) 
-				 if card.find_elements(By.CSS_SELECTOR, "[role='radiogroup'], [role='checkbox']")]
-	
-	if question_idx >= len(mcq_cards):
-		print(f"Question index {question_idx} out of range; skipping.")
-		return
+# Scrolling forces layout, so only do it for elements outside the viewport
+_SCROLL_IF_NEEDED_JS = """
+function scrollIfNeeded(el) {
+	var r = el.getBoundingClientRect();
+	if (r.top < 0 || r.bottom > window.innerHeight) el.scrollIntoView({block:'center'});
+}
+"""
 
-	card = cards[mcq_cards[question_idx]]
-	idx0 = max(0, answer_idx - 1)
 
-	# Find the appropriate option element
-	radio_group = card.find_elements(By.CSS_SELECTOR, "[role='radiogroup']")
-	if radio_group:
-		options = radio_group[0].find_elements(By.CSS_SELECTOR, "[role='radio']")
-	else:
-		options = card.find_elements(By.CSS_SELECTOR, "[role='checkbox']")
-	
-	if idx0 >= len(options):
+def select_answer(driver, mcq: MCQ, answer_idx: int) -> None:
+	"""Click the chosen answer using the option elements captured at extraction."""
+	idx0 = max(0, answer_idx - 1)
+	if idx0 >= len(mcq.option_elements):
 		print("Answer index out of range; skipping.")
 		return
 
-	# Click with retry
-	el = options[idx0]
-	driver.execute_script("arguments[0].scrollIntoView({block:'center'});", card)
-	
-	for attempt in range(3):
+	# Scroll, click and verify in one round trip
+	js = _SCROLL_IF_NEEDED_JS + """
+	var el = arguments[0];
+	scrollIfNeeded(el);
+	if (el.getAttribute('aria-checked') !== 'true') el.click();
+	return el.getAttribute('aria-checked') === 'true';
+	"""
+	el = mcq.option_elements[idx0]
+
+	def is_checked() -> bool:
+		"""Wait briefly for aria-checked; returns as soon as it flips."""
+		try:
+			WebDriverWait(driver, 1, poll_frequency=0.02).until(
+				lambda d: el.get_attribute("aria-checked") == "true"
+			)
+			return True
+		except TimeoutException:
+			return False
+
+	for attempt in range(4):
 		try:
-			if attempt == 0:
-				el.click()
-			else:
-				driver.execute_script("arguments[0].click();", el)
-			
-			# Verify selection
-			if el.get_attribute("aria-checked") == "true":
+			# The previous click may still be landing; clicking a checkbox again would untick it
+			if is_checked():
+				return
+			if attempt == 3:
+				break
+			if attempt == 1:
+				el.click()  # Native click as a second opinion
+			elif driver.execute_script(js, el):
 				return
-			time.sleep(0.1)
 		except Exception:
 			time.sleep(0.1)
 	
 	print("   Warning: selection may have failed")
 
 
+def select_answers(driver, questions: List[MCQ], answer_idxs: List[int]) -> List[bool]:
+	"""Click every chosen answer on the page in one script. Returns per-question success."""
+	js = _SCROLL_IF_NEEDED_JS + """
+	return arguments[0].map(function(el){
+		if (!el || !el.isConnected) return false;
+		if (el.getAttribute('aria-checked') !== 'true') {
+			scrollIfNeeded(el);
+			el.click();
+		}
+		return el.getAttribute('aria-checked') === 'true';
+	});
+	"""
+	targets = [
+		q.option_elements[a - 1] if 1 <= a <= len(q.option_elements) else None
+		for q, a in zip(questions, answer_idxs)
+	]
+	if not targets:
+		return []
+	try:
+		return [bool(ok) for ok in driver.execute_script(js, targets)]
+	except Exception as e:
+		print(f"Batch selection failed: {e}")
+		return [False for _ in questions]
+
+
 # ----------------------------
 # Multi-page handling helpers
 # ----------------------------
-def _page_signature(driver) -> str:
-	"""Compute a lightweight signature of current page MCQ layout to detect page changes."""
-	js = """
+# FNV-1a hash of the MCQ layout; shared by _page_state and _wait_for_next_page
+_PAGE_SIGNATURE_JS = """
+function pageSignature() {
 	var cards = Array.from(document.querySelectorAll("div[role='listitem']"));
 	var parts = cards.map(function(c){
 		var h = c.querySelector("[role='heading']");
@@ -191,30 +343,89 @@ def _page_signature(driver) -> str:
 		var cc = c.querySelectorAll("[role='checkbox']").length;
 		return qt + '|' + rc + '|' + cc;
 	});
-	return parts.join("||");
+	var s = parts.join("||");
+	var h = 2166136261;
+	for (var i = 0; i < s.length; i++) {
+		h = Math.imul(h ^ s.charCodeAt(i), 16777619) >>> 0;
+	}
+	return h;
+}
+"""
+
+
+class PageState(NamedTuple):
+	sig: int
+	has_next: bool
+	has_submit: bool
+
+
+def _page_state(driver) -> PageState:
+	"""Layout signature and Next/Submit button presence in a single round trip."""
+	js = _PAGE_SIGNATURE_JS + """
+	var labels = Array.from(document.querySelectorAll("div[role='button'] span")).map(function(s){
+		return s.textContent;
+	});
+	return [
+		pageSignature(),
+		labels.some(function(t){ return t.indexOf('Next') !== -1; }),
+		labels.some(function(t){ return t.indexOf('Submit') !== -1; })
+	];
 	"""
 	try:
-		return driver.execute_script(js)
+		sig, has_next, has_submit = driver.execute_script(js)
+		return PageState(int(sig), bool(has_next), bool(has_submit))
 	except Exception:
-		return ""
-
+		return PageState(-1, False, False)  # -1 is never a valid hash
 
-def _has_next_button(driver) -> bool:
-	return len(driver.find_elements(By.XPATH, "//div[@role='button']//span[contains(text(), 'Next')]")) > 0
 
+_WAIT_SLICE = 30  # seconds per observer script in _wait_for_next_page
 
-def _has_submit_button(driver) -> bool:
-	return len(driver.find_elements(By.XPATH, "//div[@role='button']//span[contains(text(), 'Submit')]")) > 0
 
-
-def _wait_for_next_page(driver, prev_sig: str) -> None:
+def _wait_for_next_page(driver, prev_sig: int, timeout: int = 300) -> None:
+	"""Block until the MCQ layout changes, using a MutationObserver instead of polling."""
 	print("Waiting for you to click Next...")
-	for _ in range(300):  # 5 minutes max
-		time.sleep(1)
-		new_sig = _page_signature(driver)
-		if new_sig != prev_sig:
-			time.sleep(1)  # Let page settle
+	js = _PAGE_SIGNATURE_JS + """
+	var prevSig = arguments[0], timeoutMs = arguments[1], done = arguments[arguments.length - 1];
+	var pending = false, timer;
+	var obs = new MutationObserver(function(){
+		if (pending) return;
+		pending = true;
+		// Coalesce bursts of mutations into one signature check
+		setTimeout(function(){
+			pending = false;
+			if (pageSignature() !== prevSig) {
+				obs.disconnect();
+				clearTimeout(timer);
+				done(true);
+			}
+		}, 100);
+	});
+	// Next may already have been clicked while answers were still going in
+	if (pageSignature() !== prevSig) { done(true); return; }
+	obs.observe(document.body, {childList: true, subtree: true});
+	timer = setTimeout(function(){ obs.disconnect(); done(false); }, timeoutMs);
+	"""
+	# Re-arm in short slices; the driver's HTTP client gives up on commands after about two minutes
+	deadline = time.monotonic() + timeout
+	driver.set_script_timeout(_WAIT_SLICE + 10)
+	while True:
+		remaining = deadline - time.monotonic()
+		if remaining <= 0:
 			return
+		try:
+			if driver.execute_async_script(js, prev_sig, int(min(_WAIT_SLICE, remaining) * 1000)):
+				break
+		except TimeoutException:
+			continue
+		except WebDriverException:
+			break  # Next reloads the document, which aborts the script
+	# Let the new page finish parsing instead of sleeping a fixed second
+	try:
+		WebDriverWait(driver, 10, poll_frequency=0.1, ignored_exceptions=(WebDriverException,)).until(
+			lambda d: d.execute_script("return document.readyState !== 'loading';")
+		)
+	except TimeoutException:
+		pass
 
 
 # ----------------------------
@@ -226,53 +437,68 @@ def run(url: str) -> None:
 	driver = launch_browser(url)
 	try:
 		visited = 0
+		answered_sig = None
 		while True:
+			state = _page_state(driver)
+			if state.sig == answered_sig:
+				# Same layout as the page just answered (the wait timed out); don't scan or ask again
+				_wait_for_next_page(driver, state.sig)
+				continue
+
 			visited += 1
 			print(f"\nScanning page {visited} for MCQs...")
 			mcqs = extract_mcqs(driver)
 
-			batch_size = 5
-			for start in range(0, len(mcqs), batch_size):
-				batch = mcqs[start:start + batch_size]
-				answers = ask_gemini_batch(batch)
-				batch_results = []
-				for j, q in enumerate(batch):
-					q_idx = start + j
-					ans_idx = answers[j] if j < len(answers) else None
+			# Click each chunk of answers as soon as it arrives; the rest are still in flight
+			results = [None for _ in mcqs]
+			for idxs, answers in (iter_gemini_batch(mcqs) if mcqs else ()):
+				picks = []
+				for q_idx, ans_idx in zip(idxs, answers):
+					q = mcqs[q_idx]
 					print(f"Q{q_idx+1}: {q.question_text[:80]}{'...' if len(q.question_text) > 80 else ''}")
 					print(f" - Options: {len(q.options)}")
 					if ans_idx is None:
 						print(" - Failed to get answer. Skipping question.")
 						skipped_questions.append(f"Page {visited}, Q{q_idx+1}: {q.question_text[:50]}...")
-						batch_results.append({
+						results[q_idx] = {
 							"question_number": q_idx + 1,
 							"question": q.question_text,
 							"answer_number": None,
 							"answer_text": None,
-						})
+						}
 						continue
 					print(f" - Gemini suggests option #{ans_idx}")
-					batch_results.append({
+					results[q_idx] = {
 						"question_number": q_idx + 1,
 						"question": q.question_text,
 						"answer_number": ans_idx,
 						"answer_text": q.options[ans_idx - 1] if 1 <= ans_idx <= len(q.options) else None,
-					})
+					}
+					picks.append((q_idx, q, ans_idx))
+
+				selected = select_answers(driver, [q for _, q, _ in picks], [a for _, _, a in picks])
+				for (q_idx, q, ans_idx), ok in zip(picks, selected):
+					if ok:
+						continue
 					try:
-						select_answer(driver, q_idx, ans_idx)
-						time.sleep(0.2)
+						select_answer(driver, q, ans_idx)
 					except Exception as e:
-						print(f" - Selection error: {e}")
+						print(f" - Q{q_idx+1} selection error: {e}")
+
+			# Discord embeds are kept small, so report in chunks
+			report_size = 5
+			for start in range(0, len(results), report_size):
+				send_discord_batch(webhook_url, visited, start + 1, results[start:start + report_size])
 
-				send_discord_batch(webhook_url, visited, start + 1, batch_results)
+			if state.sig != -1:
+				answered_sig = state.sig
 
-			prev_sig = _page_signature(driver)
-			if _has_next_button(driver):
+			if state.has_next:
 				print("Next button detected. Please click it manually when ready.")
-				_wait_for_next_page(driver, prev_sig)
+				_wait_for_next_page(driver, state.sig)
 				continue
 
-			if _has_submit_button(driver):
+			if state.has_submit:
 				print("\nAll MCQs answered. Please review and click Submit manually.")
 				break
 		if skipped_questions:
@@ -280,7 +506,7 @@ def run(url: str) -> None:
 			for sq in skipped_questions:
 				print(f" - {sq}")
 	finally:
-		# Do not close; keep open for review
+		# Do not close the browser; keep open for review
 		pass
 
 
@@ -290,6 +516,7 @@ def main():
 	url = sys.argv[1] if len(sys.argv) > 1 else input("Enter Google Form URL: ").strip()
 	run(url)
 	input("\nPress Enter to close...")
+	flush_discord()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
-from dataclasses import dataclass
-from typing import List
+from dataclasses import dataclass, field
+from typing import Any, List
 
 
 @dataclass
 class MCQ:
 	kind: str  # 'radio' or 'checkbox'
 	question_text: str
-	options: List[str]
\ No newline at end of file
+	options: List[str]
+	option_elements: List[Any] = field(default_factory=list, repr=False, compare=False)  # WebElements, aligned with options
\ No newline at end of file